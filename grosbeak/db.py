@@ -1,6 +1,9 @@
 import uuid
-from typing import Literal
+from typing import Any, Literal
 import pymongo
+import pymongo.errors
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient
 
 from .env import env
 
@@ -33,7 +36,19 @@ COLLECTION_KEYS: dict[DocumentTypes, list[str]] = {
 
 STATIC_FILE_TYPES = {"match-schedule", "team-list"}
 
-client: pymongo.MongoClient = pymongo.MongoClient(env.MONGO_URI)
+# Keep a warm pool of connections so bursts of requests don't wait on new ones,
+# and compress traffic since documents are large and repetitive
+CLIENT_OPTIONS: dict[str, Any] = {
+    "maxPoolSize": 50,
+    "minPoolSize": 10,
+    "waitQueueTimeoutMS": 2000,
+    "socketTimeoutMS": 10000,
+    "compressors": "zstd,zlib",
+}
+
+client: pymongo.MongoClient = pymongo.MongoClient(env.MONGO_URI, **CLIENT_OPTIONS)
+# Used by endpoints that fan out many reads at once
+async_client: AsyncIOMotorClient = AsyncIOMotorClient(env.MONGO_URI, **CLIENT_OPTIONS)
 
 api_db = client["api"]
 
@@ -45,3 +60,11 @@ if "credentials" not in api_db.list_collection_names():
             "api_key": str(uuid.uuid4()).replace("-", ""),
         }
     )
+
+# Static files are always looked up by event key
+for static_type in STATIC_FILE_TYPES:
+    try:
+        client["static"][static_type].create_index("event_key", unique=True)
+    except pymongo.errors.OperationFailure:
+        # Existing duplicate event keys or a conflicting index shouldn't stop the app
+        logger.exception(f"Failed to create the event_key index for {static_type}")
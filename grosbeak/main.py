@@ -1,11 +1,12 @@
+import asyncio
 import time
 
 from fastapi import FastAPI, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from grosbeak.routers import api, admin, picklist, stand_strategist
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 
 @app.middleware("http")
@@ -17,6 +18,17 @@ async def add_process_time_header(request: Request, call_next):
     return response
 
 
+@app.on_event("startup")
+async def start_viewer_refresh():
+    # Keep a reference to the task so it isn't garbage collected
+    app.state.viewer_refresh = asyncio.create_task(api.refresh_default_viewer())
+
+
+@app.on_event("shutdown")
+async def stop_viewer_refresh():
+    app.state.viewer_refresh.cancel()
+
+
 app.include_router(api.router)
 app.include_router(picklist.router)
 app.include_router(admin.router)
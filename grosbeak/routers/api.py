@@ -1,28 +1,62 @@
+import asyncio
+import time
+from collections import OrderedDict
 from enum import Enum
-from functools import reduce
-from typing import Annotated, Any, TypedDict, cast
-from fastapi import APIRouter, Query, Security
-from fastapi.responses import JSONResponse
+from functools import lru_cache
+from typing import Annotated, Any, TypedDict
+from fastapi import APIRouter, Header, Query, Security
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    JSONResponse,
+    ORJSONResponse,
+    Response,
+    StreamingResponse,
+)
+from loguru import logger
 from pydantic import BaseModel
 from ..auth import get_auth_level
 from ..db import (
     COLLECTION_KEYS,
     STATIC_FILE_TYPES,
     AllianceColors,
+    async_client,
     client,
     COLLECTIONS,
     DocumentTypes,
 )
 from ..env import env
-from ..util import serialize_documents
+from ..util import etag_matches, iter_json_array, make_etag
+from ..viewer import (
+    KeyExtractor,
+    make_key_extractor,
+    merge_viewer_documents,
+    prune_empty,
+)
 from grosbeak.routers.notes import router as notes_router
-import math
-import numbers
+import orjson
 
 router = APIRouter(prefix="/api", dependencies=[Security(get_auth_level)])
 
 router.include_router(notes_router)
 
+# Number of documents fetched per round-trip when reading whole collections
+READ_BATCH_SIZE = 1000
+# Field used to tag viewer documents with the collection they were read from
+SOURCE_COLLECTION_FIELD = "_source_collection"
+# Number of seconds the list of collections in an event database is cached for
+COLLECTION_NAMES_TTL = 60
+# Longest number of seconds an in place update can take to change the viewer ETag
+VIEWER_ETAG_TTL = 10
+# Number of encoded viewer responses kept, by ETag
+VIEWER_CACHE_SIZE = 8
+
+# Number of seconds between rebuilds of the viewer response for the default parameters
+VIEWER_REFRESH_SECONDS = 5
+
+_viewer_payloads: OrderedDict[str, bytes] = OrderedDict()
+# ETag and encoded viewer data for the default parameters, kept by refresh_default_viewer
+_default_viewer: tuple[str, bytes] | None = None
+
 
 class ErrorMessage(BaseModel):
     """
@@ -32,19 +66,44 @@ class ErrorMessage(BaseModel):
     error: str
 
 
-@router.get("/collection/{collection_name}", responses={404: {"model": ErrorMessage}})
+@lru_cache(maxsize=16)
+def _collections_for(event_key: str, ttl_hash: int) -> frozenset[str]:
+    """
+    Gets the names of the collections in an event database.
+    ttl_hash is only part of the cache key, it changes every COLLECTION_NAMES_TTL seconds
+    so cached names expire.
+    """
+    return frozenset(client[event_key].list_collection_names())
+
+
+def collections_for(event_key: str) -> frozenset[str]:
+    """
+    Gets the names of the collections in an event database, cached for up to
+    COLLECTION_NAMES_TTL seconds
+    """
+    return _collections_for(event_key, int(time.monotonic() // COLLECTION_NAMES_TTL))
+
+
+@router.get(
+    "/collection/{collection_name}",
+    response_class=ORJSONResponse,
+    responses={404: {"model": ErrorMessage}},
+)
 def read_collection(collection_name: str, event_key: str = env.DB_NAME):
     """
     This endpoint gets all documents from a collection in the database for a given event
     and returns them in list of objects.
     """
-    db = client[event_key]
-    if (
-        collection_name in COLLECTIONS.keys()
-        and collection_name in db.list_collection_names()
+    if collection_name in COLLECTIONS.keys() and collection_name in collections_for(
+        event_key
     ):
-        collection = db[collection_name]
-        return serialize_documents(list(collection.find()))
+        collection = client[event_key][collection_name]
+        # Let Mongo drop the _id and send documents back in large batches
+        cursor = collection.find({}, projection={"_id": 0}).batch_size(READ_BATCH_SIZE)
+        # Encode documents as they arrive instead of holding the whole collection
+        return StreamingResponse(
+            iter_json_array(cursor, READ_BATCH_SIZE), media_type="application/json"
+        )
     else:
         return JSONResponse(
             content={"error": "Collection not found/allowed"}, status_code=404
@@ -82,11 +141,13 @@ class MatchScheduleMatch(BaseModel):
     response_model=dict[str, MatchScheduleMatch],
     responses={404: {"model": ErrorMessage}},
 )
-def read_match_schedule(event_key: str):
+def read_match_schedule(
+    event_key: str, if_none_match: Annotated[str | None, Header()] = None
+):
     """
     This endpoint gets the match schedule for a given event and returns it
     """
-    return read_static_json("match-schedule", event_key)
+    return read_static_json("match-schedule", event_key, if_none_match)
 
 
 @router.get(
@@ -94,11 +155,13 @@ def read_match_schedule(event_key: str):
     response_model=list[str],
     responses={404: {"model": ErrorMessage}},
 )
-def read_team_list(event_key: str):
+def read_team_list(
+    event_key: str, if_none_match: Annotated[str | None, Header()] = None
+):
     """
     This endpoint gets the team list for a given event and returns it
     """
-    return read_static_json("team-list", event_key)
+    return read_static_json("team-list", event_key, if_none_match)
 
 
 class ViewerData(TypedDict):
@@ -113,50 +176,146 @@ class ViewerData(TypedDict):
     auto_paths: dict[str, dict[str, dict[str, Any]]]
 
 
-def make_key(collection_type: DocumentTypes, document: dict[str, Any]) -> list[str]:
+KEY_EXTRACTORS: dict[DocumentTypes, KeyExtractor] = {
+    collection_type: make_key_extractor(headers)
+    for collection_type, headers in COLLECTION_KEYS.items()
+}
+
+
+# How many levels deep the documents of each collection type are nested in the viewer data
+VIEWER_KEY_DEPTHS: dict[DocumentTypes, int] = {
+    collection_type: len(headers)
+    for collection_type, headers in COLLECTION_KEYS.items()
+}
+
+
+def make_viewer_layout(team_list: Any, match_schedule: Any) -> ViewerData:
+    """
+    Builds the nested dictionaries of viewer data for the teams and matches in the
+    team list and match schedule, so most documents land in a dictionary that already exists
+    """
+    teams = [str(team) for team in team_list] if isinstance(team_list, list) else []
+    matches = match_schedule if isinstance(match_schedule, dict) else {}
+    # Static files are stored as they are uploaded, so malformed matches and teams
+    # are skipped instead of failing the whole response
+    tim: dict[str, dict[str, dict]] = {}
+    for match_number, match in matches.items():
+        match_teams = match.get("teams") if isinstance(match, dict) else None
+        if not isinstance(match_teams, list):
+            continue
+        tim[str(match_number)] = {
+            str(team["number"]): {}
+            for team in match_teams
+            if isinstance(team, dict) and "number" in team
+        }
+    return {
+        "team": {team: {} for team in teams},
+        "tim": tim,
+        "aim": {str(match_number): {"red": {}, "blue": {}} for match_number in matches},
+        "alliance": {},
+        "auto_paths": {team: {} for team in teams},
+    }
+
+
+def make_viewer_pipeline(
+    collections: list[str], id_collections: frozenset[str] = frozenset()
+) -> list[dict[str, Any]]:
+    """
+    Builds an aggregation pipeline that reads every document from all of the collections
+    in one command. The _id is left out unless the collection is in id_collections.
+    Documents are tagged with the name of the collection they came from
+    and keep the order of the collections.
+    Needs MongoDB 4.4+ for $unionWith.
+    """
+
+    def read_stages(collection: str) -> list[dict[str, Any]]:
+        tag = {"$set": {SOURCE_COLLECTION_FIELD: {"$literal": collection}}}
+        if collection in id_collections:
+            return [tag]
+        return [{"$project": {"_id": 0}}, tag]
+
+    first_collection, *other_collections = collections
+    return read_stages(first_collection) + [
+        {"$unionWith": {"coll": collection, "pipeline": read_stages(collection)}}
+        for collection in other_collections
+    ]
+
+
+async def read_viewer_collections(
+    event_key: str, collections: list[str], id_collections: frozenset[str]
+) -> dict[str, list[dict[str, Any]]]:
     """
-    Makes a key from a team, tim, aim, or alliance document for referencing
+    Reads all documents from the collections in a single aggregate command
+    and groups them by collection. Only documents from id_collections keep their _id.
     """
-    keys = []
-    for header in COLLECTION_KEYS[collection_type]:
-        if header == "alliance_color_is_red":
-            alliance_color_is_red = document["alliance_color_is_red"]
-            if alliance_color_is_red:
-                keys.append("red")
-            else:
-                keys.append("blue")
-        else:
-            keys.append(str(document[header]))
-        document.pop(header)
-    return keys
+    documents_by_collection: dict[str, list[dict[str, Any]]] = {
+        collection: [] for collection in collections
+    }
+    if not collections:
+        return documents_by_collection
+    cursor = async_client[event_key][collections[0]].aggregate(
+        make_viewer_pipeline(collections, id_collections),
+        allowDiskUse=True,
+        batchSize=READ_BATCH_SIZE,
+    )
+    async for doc in cursor:
+        documents_by_collection[doc.pop(SOURCE_COLLECTION_FIELD)].append(doc)
+    return documents_by_collection
 
 
-def get_by_path(dictionary: dict, path: list[str]) -> Any:
+async def read_static_data(static_type: str, event_key: str) -> Any:
     """
-    Gets a value in a nested dictionary by a list of strings
+    Reads the data of a static file from the database, or None if there isn't one
     """
-    return reduce(lambda d, key: d.get(key) if d else None, path, dictionary)  # type: ignore
+    collection = async_client["static"][static_type]
+    document = await collection.find_one({"event_key": event_key})
+    return None if document is None else document["data"]
 
 
-def set_by_path(dictionary: dict, path: list[str], value: Any):
+async def read_collection_version(
+    event_key: str, collection: str
+) -> tuple[int, str | None]:
     """
-    Sets a value in a nested dictionary by a list of strings
+    Gets the number of documents and the newest _id in a collection.
+    These change whenever a document is added or removed.
     """
-    reduce(lambda d, key: d.setdefault(key, {}), path[:-1], dictionary)[
-        path[-1]
-    ] = value
+    db = async_client[event_key]
+    count, newest = await asyncio.gather(
+        db[collection].estimated_document_count(),
+        db[collection].find_one({}, sort=[("_id", -1)], projection={"_id": 1}),
+    )
+    return count, None if newest is None else str(newest["_id"])
 
 
-def serialize_viewer_document(document: dict[str, Any]):
+async def make_viewer_etag(
+    event_key: str,
+    collections: list[str],
+    use_strings: bool,
+    ignored_to_string_datapoints: frozenset[str],
+    ignored_to_string_collections: frozenset[str],
+) -> str:
     """
-    Removes the _id from a document and returns the document
+    Makes an entity tag for the viewer data from the parameters and the versions of the collections.
+    Documents updated in place don't change a version, so the time is also part of the tag
+    and they show up within VIEWER_ETAG_TTL seconds.
     """
-    document.pop("_id", None)
-    return document
+    versions = await asyncio.gather(
+        *(read_collection_version(event_key, collection) for collection in collections)
+    )
+    parts = (
+        event_key,
+        collections,
+        use_strings,
+        sorted(ignored_to_string_datapoints),
+        sorted(ignored_to_string_collections),
+        versions,
+        int(time.time() // VIEWER_ETAG_TTL),
+    )
+    return make_etag(repr(parts).encode(), weak=True)
 
 
-@router.get("/viewer")
-def get_viewer_data(
+@router.get("/viewer", response_model=None, response_class=ORJSONResponse)
+async def get_viewer_data(
     use_strings: Annotated[bool, Query()] = False,
     event_key: Annotated[str, Query()] = env.DB_NAME,
     ignored_collections: Annotated[list[str] | None, Query()] = None,
@@ -166,58 +325,173 @@ def get_viewer_data(
     ignored_to_string_collections: Annotated[
         list[str] | None, Query(alias="itsc")
     ] = None,
-) -> ViewerData:
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
     """
     This function uses hard code "collections of collections" to try to relate different collections.
     This data is much easier for viewer to understand.
 
+    The response has an ETag, if it matches the If-None-Match header a 304 is returned instead.
+    With the default parameters the response is served from memory, it is rebuilt
+    from the database every VIEWER_REFRESH_SECONDS.
+    """
+    # Sets so the checks in the merge loop don't scan a list
+    ignored = frozenset(ignored_collections or ())
+    ignored_datapoints = frozenset(ignored_to_string_datapoints or ())
+    ignored_to_string = frozenset(ignored_to_string_collections or ())
+    collections = [
+        collection for collection in COLLECTIONS if collection not in ignored
+    ]
+    content: bytes | None = None
+    # The response for the default parameters is kept up to date in the background,
+    # itsd and itsc don't change anything without use_strings
+    if (
+        _default_viewer is not None
+        and not use_strings
+        and event_key == env.DB_NAME
+        and not ignored
+    ):
+        etag, content = _default_viewer
+    else:
+        etag = await make_viewer_etag(
+            event_key, collections, use_strings, ignored_datapoints, ignored_to_string
+        )
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if content is None:
+        content = await read_viewer_payload(
+            etag,
+            event_key,
+            collections,
+            use_strings,
+            ignored_datapoints,
+            ignored_to_string,
+        )
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+async def read_viewer_payload(
+    etag: str,
+    event_key: str,
+    collections: list[str],
+    use_strings: bool,
+    ignored_to_string_datapoints: frozenset[str],
+    ignored_to_string_collections: frozenset[str],
+) -> bytes:
     """
-    db = client[event_key]
-    data: ViewerData = cast(
-        ViewerData, {collection_type: {} for collection_type in COLLECTION_KEYS}
+    Gets the encoded viewer data for an ETag from the cache, or builds and caches it
+    """
+    content = _viewer_payloads.get(etag)
+    if content is not None:
+        _viewer_payloads.move_to_end(etag)
+        return content
+    content = await build_viewer_payload(
+        event_key,
+        collections,
+        use_strings,
+        ignored_to_string_datapoints,
+        ignored_to_string_collections,
     )
+    _viewer_payloads[etag] = content
+    if len(_viewer_payloads) > VIEWER_CACHE_SIZE:
+        _viewer_payloads.popitem(last=False)
+    return content
 
-    for collection, collection_type in COLLECTIONS.items():
-        if ignored_collections is not None and collection in ignored_collections:
-            continue
-        documents = db[collection].find()
-        for doc in documents:
-            key = make_key(collection_type, doc)
-            # Dictionary for this specific key
-            common_doc = get_by_path(data[collection_type], key)
-            # If the dictionary doesn't exist, create it
-            if common_doc is None:
-                common_doc = {}
-                set_by_path(data[collection_type], key, common_doc)
-            # Sending _id to viewer is generally not a good idea and is just wasting space
-            # https://stackoverflow.com/a/62706325
-            sanitized = serialize_viewer_document(doc)
-            if use_strings and (
-                (ignored_to_string_collections is None)
-                or (collection not in ignored_to_string_collections)
-            ):
-                # Loop through all the datapoints in the document
-                for k, v in sanitized.items():
-                    if (ignored_to_string_datapoints is not None) and (
-                        k in ignored_to_string_datapoints
-                    ):
-                        continue
-                    # Only convert non primitives (like lists, dicts, or other classes) to strings
-                    if not isinstance(v, (float, int, str, bool, type(None))):
-                        sanitized[k] = str(v)
-            for k in sanitized:
-                if isinstance(sanitized[k], numbers.Number) and math.isnan(
-                    sanitized[k]
-                ):
-                    sanitized[k] = None
-            # Add the document to the dictionary
-            common_doc.update(sanitized)
-    return data
-
-
-def read_static_json(static_type: str, event_key: str):
-    """
-    This function reads a static file from the database and returns it
+
+async def refresh_default_viewer():
+    """
+    Rebuilds the viewer response for the default parameters every VIEWER_REFRESH_SECONDS
+    so most viewer requests don't touch the database. Runs until it is cancelled.
+    """
+    global _default_viewer
+    collections = list(COLLECTIONS)
+    nothing_ignored: frozenset[str] = frozenset()
+    while True:
+        try:
+            etag = await make_viewer_etag(
+                env.DB_NAME, collections, False, nothing_ignored, nothing_ignored
+            )
+            # Not read through the ETag cache, the tag stays the same for
+            # VIEWER_ETAG_TTL seconds while documents can change in place
+            content = await build_viewer_payload(
+                env.DB_NAME, collections, False, nothing_ignored, nothing_ignored
+            )
+            _default_viewer = (etag, content)
+        except Exception:
+            # Don't serve stale data while the database can't be read
+            _default_viewer = None
+            logger.exception("Failed to refresh the default viewer data")
+        await asyncio.sleep(VIEWER_REFRESH_SECONDS)
+
+
+async def build_viewer_payload(
+    event_key: str,
+    collections: list[str],
+    use_strings: bool,
+    ignored_to_string_datapoints: frozenset[str],
+    ignored_to_string_collections: frozenset[str],
+) -> bytes:
+    """
+    Reads the collections and merges their documents into the encoded viewer data.
+    Only the reads run on the event loop, merging and encoding run in a worker thread
+    so other requests aren't blocked.
+    """
+    # Stringified collections keep their _id to look up already converted documents
+    stringified = frozenset(
+        collection
+        for collection in collections
+        if use_strings and collection not in ignored_to_string_collections
+    )
+    # Read the static files and all of the collections at the same time,
+    # the collections are read in one round-trip
+    team_list, match_schedule, documents_by_collection = await asyncio.gather(
+        read_static_data("team-list", event_key),
+        read_static_data("match-schedule", event_key),
+        read_viewer_collections(event_key, collections, stringified),
+    )
+    return await run_in_threadpool(
+        encode_viewer_data,
+        team_list,
+        match_schedule,
+        documents_by_collection,
+        stringified,
+        ignored_to_string_datapoints,
+    )
+
+
+def encode_viewer_data(
+    team_list: Any,
+    match_schedule: Any,
+    documents_by_collection: dict[str, list[dict[str, Any]]],
+    stringified: frozenset[str],
+    ignored_to_string_datapoints: frozenset[str],
+) -> bytes:
+    """
+    Merges the documents into the layout of the team list and match schedule
+    and encodes the viewer data as JSON
+    """
+    data = make_viewer_layout(team_list, match_schedule)
+    merge_viewer_documents(
+        data,
+        documents_by_collection,
+        COLLECTIONS,
+        KEY_EXTRACTORS,
+        stringified,
+        ignored_to_string_datapoints,
+    )
+    # Drop teams and matches from the layout that had no documents
+    for collection_type, depth in VIEWER_KEY_DEPTHS.items():
+        prune_empty(data[collection_type], depth)
+    return orjson.dumps(data)
+
+
+def read_static_json(
+    static_type: str, event_key: str, if_none_match: str | None = None
+):
+    """
+    This function reads a static file from the database and returns it.
+    The response has an ETag, if it matches if_none_match a 304 is returned instead.
     """
     if static_type not in STATIC_FILE_TYPES:
         return JSONResponse(
@@ -228,5 +502,10 @@ def read_static_json(static_type: str, event_key: str):
     document = collection.find_one({"event_key": event_key})
     if document is None:
         return JSONResponse(content={"error": "Static file not found"}, status_code=404)
-    else:
-        return JSONResponse(content=document["data"])
+    # Returned as a response so it isn't validated against the response model,
+    # which is only used for the docs
+    content = orjson.dumps(document["data"])
+    headers = {"ETag": make_etag(content), "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
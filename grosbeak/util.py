@@ -1,5 +1,9 @@
+import hashlib
 from os import listdir
 from os.path import isfile, join
+from typing import Any, Iterable, Iterator
+
+import orjson
 
 
 def all_files_in_dir(dir: str) -> list[str]:
@@ -30,3 +34,48 @@ def serialize_documents(docs: list[dict]) -> list[dict]:
         doc.pop("_id", None)
 
     return docs
+
+
+def make_etag(content: bytes, weak: bool = False) -> str:
+    """
+    This function makes an HTTP entity tag by hashing some content.
+    Weak tags are for content that means the same thing
+    but might not be identical byte for byte.
+    """
+    tag = f'"{hashlib.sha1(content).hexdigest()}"'
+    return f"W/{tag}" if weak else tag
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    This function checks if an If-None-Match header has an entity tag.
+    Tags are compared weakly, so a W/ prefix on either side is ignored.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
+def iter_json_array(
+    documents: Iterable[Any], chunk_size: int = 1000
+) -> Iterator[bytes]:
+    """
+    This function encodes documents as a JSON array piece by piece.
+    It yields chunk_size documents at a time so the whole array
+    never has to be in memory at once.
+    """
+    chunk = [b"["]
+    for i, document in enumerate(documents):
+        if i > 0:
+            chunk.append(b",")
+            if i % chunk_size == 0:
+                yield b"".join(chunk)
+                chunk = []
+        chunk.append(orjson.dumps(document))
+    chunk.append(b"]")
+    yield b"".join(chunk)
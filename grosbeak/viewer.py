@@ -0,0 +1,171 @@
+"""
+Merges documents from many collections into the nested viewer data.
+This is the hot loop of the viewer API, it doesn't import the app or the database
+so it can be tested (and compiled) on its own.
+"""
+from threading import Lock
+from typing import Any, Callable, Mapping, Sequence
+
+# Datapoint types that are sent to viewer as they are when use_strings is set
+_PRIMITIVES = (float, int, str, bool, type(None))
+
+# Number of stringified documents kept before the cache is cleared
+STRINGIFIED_CACHE_SIZE = 50000
+
+# Maps (_id, ignored datapoints) to the original document and its stringified datapoints
+_stringified_documents: dict[
+    tuple[Any, frozenset[str]], tuple[dict[str, Any], dict[str, Any]]
+] = {}
+# The merge runs in worker threads, so the cache is only touched while holding this
+_stringified_documents_lock = Lock()
+
+KeyExtractor = Callable[[dict[str, Any]], tuple[str, ...]]
+
+
+def make_key_extractor(headers: list[str]) -> KeyExtractor:
+    """
+    Builds a function that makes a key from a team, tim, aim, or alliance document
+    for referencing. The key headers are baked in so nothing is looked up per document.
+    """
+    if len(headers) == 1:
+        (header,) = headers
+
+        def extract_key(document: dict[str, Any]) -> tuple[str, ...]:
+            return (str(document.pop(header)),)
+
+    elif headers[1] == "alliance_color_is_red":
+        first_header = headers[0]
+
+        def extract_key(document: dict[str, Any]) -> tuple[str, ...]:
+            return (
+                str(document.pop(first_header)),
+                "red" if document.pop("alliance_color_is_red") else "blue",
+            )
+
+    else:
+        first_header, second_header = headers
+
+        def extract_key(document: dict[str, Any]) -> tuple[str, ...]:
+            return (str(document.pop(first_header)), str(document.pop(second_header)))
+
+    return extract_key
+
+
+def get_by_path(dictionary: dict, path: Sequence[str]) -> Any:
+    """
+    Gets a value in a nested dictionary by a list of strings
+    """
+    # Every viewer key is one or two long, so skip the loop for those
+    if len(path) == 1:
+        return dictionary.get(path[0])
+    if len(path) == 2:
+        inner = dictionary.get(path[0])
+        return None if inner is None else inner.get(path[1])
+    value: Any = dictionary
+    for key in path:
+        if value is None:
+            return None
+        value = value.get(key)
+    return value
+
+
+def set_by_path(dictionary: dict, path: Sequence[str], value: Any):
+    """
+    Sets a value in a nested dictionary by a list of strings
+    """
+    for key in path[:-1]:
+        inner = dictionary.get(key)
+        if inner is None:
+            inner = dictionary[key] = {}
+        dictionary = inner
+    dictionary[path[-1]] = value
+
+
+def prune_empty(dictionary: dict, depth: int):
+    """
+    Removes empty dictionaries from a nested dictionary, up to depth levels deep
+    """
+    for key, value in list(dictionary.items()):
+        if depth > 1:
+            prune_empty(value, depth - 1)
+        if not value:
+            del dictionary[key]
+
+
+def stringify_document(
+    document: dict[str, Any],
+    extract_key: KeyExtractor,
+    ignored_datapoints: frozenset[str],
+) -> tuple[tuple[str, ...], dict[str, Any]]:
+    """
+    Makes the key for a document and converts its non primitive datapoints to strings.
+    The converted datapoints are cached by _id and reused while the document is unchanged.
+    """
+    cache_key = (document.pop("_id"), ignored_datapoints)
+    # The key is left out of the comparison, it is cheap to make and can change
+    key = extract_key(document)
+    with _stringified_documents_lock:
+        cached = _stringified_documents.get(cache_key)
+    if cached is not None and cached[0] == document:
+        return key, cached[1]
+    datapoints = {}
+    has_nan = False
+    for k, v in document.items():
+        # Only convert non primitives (like lists, dicts, or other classes) to strings
+        if not isinstance(v, _PRIMITIVES) and k not in ignored_datapoints:
+            v = str(v)
+        # NaN is the only value that isn't equal to itself
+        elif isinstance(v, float) and v != v:
+            v = None
+            has_nan = True
+        datapoints[k] = v
+    # Documents with NaN never compare equal to the cached one, so don't cache them
+    if not has_nan:
+        with _stringified_documents_lock:
+            if len(_stringified_documents) >= STRINGIFIED_CACHE_SIZE:
+                _stringified_documents.clear()
+            _stringified_documents[cache_key] = (document, datapoints)
+    return key, datapoints
+
+
+def merge_viewer_documents(
+    data: Mapping[str, Any],
+    documents_by_collection: Mapping[str, list[dict[str, Any]]],
+    collection_types: Mapping[str, str],
+    key_extractors: Mapping[Any, KeyExtractor],
+    stringified: frozenset[str] = frozenset(),
+    ignored_datapoints: frozenset[str] = frozenset(),
+):
+    """
+    Merges the documents of each collection into data, under the collection's type and
+    the document's key. Documents with the same key are merged together, with later
+    collections overwriting datapoints of earlier ones.
+    Documents from stringified collections need an _id and are converted with stringify_document.
+    """
+    for collection, documents in documents_by_collection.items():
+        collection_type = collection_types[collection]
+        collection_data = data[collection_type]
+        extract_key = key_extractors[collection_type]
+        stringify = collection in stringified
+        for doc in documents:
+            if stringify:
+                key, datapoints = stringify_document(
+                    doc, extract_key, ignored_datapoints
+                )
+            else:
+                key = extract_key(doc)
+            # Dictionary for this specific key
+            common_doc = get_by_path(collection_data, key)
+            # If the dictionary doesn't exist (not in the team list or match schedule), create it
+            if common_doc is None:
+                common_doc = {}
+                set_by_path(collection_data, key, common_doc)
+            if stringify:
+                common_doc.update(datapoints)
+                continue
+            # Sanitize each datapoint and add it to the dictionary in a single pass
+            for k, v in doc.items():
+                # NaN is the only value that isn't equal to itself
+                if isinstance(v, float) and v != v:
+                    v = None
+                common_doc[k] = v
@@ -1,6 +1,33 @@
+import json
+
 import grosbeak.util as util
 
 
 def test_strip_extension():
     assert util.strip_extension("test_file.txt") == "test_file"
     assert util.strip_extension("test_file.test.json") == "test_file"
+
+
+def test_make_etag():
+    assert util.make_etag(b"data") == util.make_etag(b"data")
+    assert util.make_etag(b"data") != util.make_etag(b"other data")
+    assert util.make_etag(b"data").startswith('"')
+    assert util.make_etag(b"data", weak=True) == "W/" + util.make_etag(b"data")
+
+
+def test_etag_matches():
+    etag = util.make_etag(b"data", weak=True)
+    assert util.etag_matches(etag, etag)
+    assert util.etag_matches(etag.removeprefix("W/"), etag)
+    assert util.etag_matches(f'"other", {etag}', etag)
+    assert util.etag_matches("*", etag)
+    assert not util.etag_matches('"other"', etag)
+    assert not util.etag_matches(None, etag)
+
+
+def test_iter_json_array():
+    documents = [{"team_number": str(i), "value": i / 2} for i in range(10)]
+    chunks = list(util.iter_json_array(documents, chunk_size=3))
+    assert len(chunks) == 4
+    assert json.loads(b"".join(chunks)) == documents
+    assert json.loads(b"".join(util.iter_json_array([]))) == []
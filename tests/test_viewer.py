@@ -0,0 +1,133 @@
+import grosbeak.viewer as viewer
+
+COLLECTION_TYPES = {"obj_tim": "tim", "subj_tim": "tim", "predicted_aim": "aim"}
+KEY_EXTRACTORS = {
+    "tim": viewer.make_key_extractor(["match_number", "team_number"]),
+    "aim": viewer.make_key_extractor(["match_number", "alliance_color_is_red"]),
+}
+
+
+def test_make_key_extractor():
+    document = {"match_number": 1, "alliance_color_is_red": False, "score": 10}
+    assert KEY_EXTRACTORS["aim"](document) == ("1", "blue")
+    assert document == {"score": 10}
+
+
+def test_get_and_set_by_path():
+    data: dict = {}
+    viewer.set_by_path(data, ["1", "1678"], {"score": 10})
+    assert data == {"1": {"1678": {"score": 10}}}
+    assert viewer.get_by_path(data, ["1", "1678"]) == {"score": 10}
+    assert viewer.get_by_path(data, ["2", "1678"]) is None
+    assert viewer.get_by_path(data, ["1"]) == {"1678": {"score": 10}}
+
+
+def test_prune_empty():
+    data = {"1": {"1678": {}, "254": {"score": 10}}, "2": {"1678": {}}}
+    viewer.prune_empty(data, 2)
+    assert data == {"1": {"254": {"score": 10}}}
+
+
+def test_merge_viewer_documents():
+    data: dict = {"tim": {"1": {"1678": {}}}, "aim": {}}
+    viewer.merge_viewer_documents(
+        data,
+        {
+            "obj_tim": [
+                {"match_number": 1, "team_number": "1678", "score": 10, "a": 1.0},
+                {"match_number": 2, "team_number": "254", "score": float("nan")},
+            ],
+            "subj_tim": [{"match_number": 1, "team_number": "1678", "a": 2.0}],
+            "predicted_aim": [
+                {"match_number": 1, "alliance_color_is_red": True, "score": 50}
+            ],
+        },
+        COLLECTION_TYPES,
+        KEY_EXTRACTORS,
+    )
+    assert data == {
+        "tim": {
+            "1": {"1678": {"score": 10, "a": 2.0}},
+            "2": {"254": {"score": None}},
+        },
+        "aim": {"1": {"red": {"score": 50}}},
+    }
+
+
+def test_merge_viewer_documents_nan_subclass():
+    class Float(float):
+        pass
+
+    data: dict = {"tim": {}}
+    viewer.merge_viewer_documents(
+        data,
+        {"obj_tim": [{"match_number": 1, "team_number": "1678", "a": Float("nan")}]},
+        COLLECTION_TYPES,
+        KEY_EXTRACTORS,
+    )
+    assert data == {"tim": {"1": {"1678": {"a": None}}}}
+
+
+def test_merge_viewer_documents_stringified():
+    def documents():
+        return {
+            "obj_tim": [
+                {
+                    "_id": "a",
+                    "match_number": 1,
+                    "team_number": "1678",
+                    "path": [1, 2],
+                    "notes": {"x": 1},
+                }
+            ]
+        }
+
+    for _ in range(2):
+        data: dict = {"tim": {}}
+        viewer.merge_viewer_documents(
+            data,
+            documents(),
+            COLLECTION_TYPES,
+            KEY_EXTRACTORS,
+            stringified=frozenset(["obj_tim"]),
+            ignored_datapoints=frozenset(["notes"]),
+        )
+        assert data == {"tim": {"1": {"1678": {"path": "[1, 2]", "notes": {"x": 1}}}}}
+
+    # A changed document with the same _id isn't served from the cache
+    changed = documents()
+    changed["obj_tim"][0]["path"] = [3]
+    data = {"tim": {}}
+    viewer.merge_viewer_documents(
+        data,
+        changed,
+        COLLECTION_TYPES,
+        KEY_EXTRACTORS,
+        stringified=frozenset(["obj_tim"]),
+        ignored_datapoints=frozenset(["notes"]),
+    )
+    assert data == {"tim": {"1": {"1678": {"path": "[3]", "notes": {"x": 1}}}}}
+
+
+def test_merge_viewer_documents_stringified_nan():
+    data: dict = {"tim": {}}
+    viewer.merge_viewer_documents(
+        data,
+        {
+            "obj_tim": [
+                {"_id": "nan", "match_number": 1, "team_number": "1678", "a": 1.0},
+                {
+                    "_id": "nan",
+                    "match_number": 2,
+                    "team_number": "1678",
+                    "a": float("nan"),
+                },
+            ]
+        },
+        COLLECTION_TYPES,
+        KEY_EXTRACTORS,
+        stringified=frozenset(["obj_tim"]),
+    )
+    assert data == {"tim": {"1": {"1678": {"a": 1.0}}, "2": {"1678": {"a": None}}}}
+    # Documents with NaN never match the cache, so they aren't kept in it
+    assert viewer._stringified_documents[("nan", frozenset())][1] == {"a": 1.0}